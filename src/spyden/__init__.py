@@ -1,6 +1,6 @@
 from ._version import __version__
 from .template import Template, TemplateBank
 from .noisestats import noise_mean, noise_std
-from .snr import snratio
+from .snr import snratio, snratio_reduce
 
-__all__ = ['__version__', 'Template', 'TemplateBank', 'noise_mean', 'noise_std', 'snratio']
\ No newline at end of file
+__all__ = ['__version__', 'Template', 'TemplateBank', 'noise_mean', 'noise_std', 'snratio', 'snratio_reduce']
\ No newline at end of file
@@ -0,0 +1,314 @@
+"""
+Cached FFT plans to circularly convolve a batch of profiles with a batch of
+templates. For pulsar pipelines, snratio() is called a very large number of
+times on identically shaped inputs: creating plans and allocating work
+buffers only once per input shape removes most of the per-call overhead.
+
+When pyfftw is installed, the FFTW wisdom accumulated while planning is
+saved to disk when the interpreter exits and loaded back on import, so that
+planning for a given input shape is only slow the very first time.
+"""
+import os
+import atexit
+import logging
+import operator
+import tempfile
+import functools
+import threading
+import numpy as np
+import scipy.fft
+
+try:
+    import pyfftw
+except ImportError:
+    pyfftw = None
+
+try:
+    import cupy
+except ImportError:
+    cupy = None
+
+
+log = logging.getLogger(__name__)
+
+# True if new FFTW plans have been created since wisdom was last loaded
+_new_wisdom = False
+
+
+# Alignment in bytes of plan work buffers, enough for AVX-512 loads
+ALIGNMENT = 64
+
+
+def aligned_empty(shape, dtype, align=ALIGNMENT):
+    """
+    Same as numpy.empty(), but the returned array starts at a memory address
+    that is a multiple of 'align' bytes. numpy itself only guarantees an 
+    alignment of 16 bytes.
+    """
+    dtype = np.dtype(dtype)
+    nbytes = int(np.prod(shape)) * dtype.itemsize
+    buf = np.empty(nbytes + align, dtype=np.uint8)
+    offset = -buf.ctypes.data % align
+    return buf[offset:offset + nbytes].view(dtype).reshape(shape)
+
+
+class ScipyPlan(object):
+    """
+    Convolution plan that uses scipy.fft, multithreaded over the batch of
+    transforms. Only the work buffers are reused, scipy keeps its own 
+    internal cache of FFT twiddle factors.
+
+    Parameters
+    ----------
+    nprof: int
+        Number of profiles
+    n: int
+        Number of phase bins of the (padded) profiles and templates
+    ntemp: int
+        Number of templates
+    workers: int
+        Number of threads used to compute FFTs
+    """
+    def __init__(self, nprof, n, ntemp, workers):
+        self.nprof = nprof
+        self.n = n
+        self.ntemp = ntemp
+        self.workers = workers
+        self.lock = threading.Lock()
+        # NOTE: scipy.fft allocates its own output arrays, only the input
+        # buffers can be aligned
+        self.x = aligned_empty((nprof, n), np.float32)
+        self.prod = aligned_empty((nprof, ntemp, n // 2 + 1), np.complex64)
+
+    def forward(self):
+        """
+        Compute the rFFT of the input buffer 'x', which must have been filled
+        beforehand.
+        """
+        # NOTE: scipy.fft preserves single precision, fx is complex64
+        self.fx = scipy.fft.rfft(self.x, workers=self.workers)
+
+    def convolve(self, fy):
+        """
+        Circularly convolve every line of the input buffer 'x' with every
+        template, given the rFFT 'fy' of the prepared templates. forward()
+        must have been called beforehand.
+
+        Parameters
+        ----------
+        fy: ndarray
+            rFFT of the prepared templates, with shape (ntemp, n // 2 + 1)
+
+        Returns
+        -------
+        out: ndarray
+            Convolution output with shape (nprof, ntemp, n). This may be a
+            buffer owned by the plan, which is only valid until the next call.
+            NOTE: the inverse FFT is NOT normalised, the output is n times
+            the circular convolution. The 1/n factor is meant to be folded 
+            into the scaling of the input, which is free, rather than costing
+            an extra pass over the much larger output.
+        """
+        np.multiply(self.fx[:, None, :], fy, out=self.prod)
+        return scipy.fft.irfft(self.prod, n=self.n, norm='forward', workers=self.workers)
+
+
+class FFTWPlan(ScipyPlan):
+    """
+    Convolution plan that uses pre-planned FFTW transforms operating on
+    SIMD-aligned work buffers. Requires pyfftw.
+    """
+    def __init__(self, nprof, n, ntemp, workers):
+        self.nprof = nprof
+        self.n = n
+        self.ntemp = ntemp
+        self.workers = workers
+        self.lock = threading.Lock()
+
+        nc = n // 2 + 1
+        self.x = pyfftw.empty_aligned((nprof, n), dtype='float32')
+        self.fx = pyfftw.empty_aligned((nprof, nc), dtype='complex64')
+        self.prod = pyfftw.empty_aligned((nprof, ntemp, nc), dtype='complex64')
+        self.out = pyfftw.empty_aligned((nprof, ntemp, n), dtype='float32')
+
+        # NOTE: FFTW_MEASURE overwrites the buffers while planning, which is
+        # fine since they are always filled before execution
+        flags = ('FFTW_MEASURE', 'FFTW_DESTROY_INPUT')
+        self._forward = pyfftw.FFTW(
+            self.x, self.fx, axes=(-1,),
+            direction='FFTW_FORWARD', flags=flags, threads=workers)
+        self._backward = pyfftw.FFTW(
+            self.prod, self.out, axes=(-1,),
+            direction='FFTW_BACKWARD', flags=flags, threads=workers)
+
+        global _new_wisdom
+        _new_wisdom = True
+
+    def forward(self):
+        self._forward.execute()
+
+    def convolve(self, fy):
+        np.multiply(self.fx[:, None, :], fy, out=self.prod)
+        # NOTE: execute() does not normalise the inverse transform
+        self._backward.execute()
+        return self.out
+
+
+class CupyPlan(object):
+    """
+    Convolution plan that computes FFTs and products on the GPU with cupy,
+    which keeps its own cache of cuFFT plans. The input buffer 'x' lives in
+    host memory so that it can be filled like that of the other plans, and
+    the output is copied back to host memory. Requires cupy.
+    """
+    def __init__(self, nprof, n, ntemp, workers):
+        self.nprof = nprof
+        self.n = n
+        self.ntemp = ntemp
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.x = aligned_empty((nprof, n), np.float32)
+
+    def forward(self):
+        self.fx = cupy.fft.rfft(cupy.asarray(self.x))
+
+    def convolve(self, fy):
+        # NOTE: the templates are much smaller than the output, transferring
+        # them on every call is cheap in comparison
+        prod = self.fx[:, None, :] * cupy.asarray(fy)
+        out = cupy.fft.irfft(prod, n=self.n, norm='forward')
+        return cupy.asnumpy(out)
+
+
+BACKENDS = ('cpu', 'cupy')
+
+
+def num_workers(workers):
+    """
+    Returns the actual number of threads to use given the 'workers' argument
+    of snratio(), following the same convention as scipy.fft: negative
+    values count back from the number of CPUs, -1 meaning all of them.
+    """
+    # NOTE: accept any integer type, e.g. numpy integers, but not bool
+    try:
+        if isinstance(workers, (bool, np.bool_)):
+            raise TypeError
+        workers = operator.index(workers)
+    except TypeError:
+        raise ValueError("workers must be a non-zero int")
+    if workers == 0:
+        raise ValueError("workers must be a non-zero int")
+    if workers < 0:
+        workers += (os.cpu_count() or 1) + 1
+    if workers < 1:
+        raise ValueError("workers must not be lower than -{}".format(os.cpu_count()))
+    return workers
+
+
+def check_backend(backend):
+    """
+    Raise ValueError if 'backend' is not a valid value for the 'backend'
+    argument of snratio(), or if it requires a package that is missing.
+    """
+    if not backend in BACKENDS:
+        raise ValueError("backend must be one of: {!r}".format(BACKENDS))
+    if backend == 'cupy' and cupy is None:
+        raise ValueError("backend 'cupy' requires cupy to be installed")
+
+
+@functools.lru_cache(maxsize=4)
+def get_plan(nprof, n, ntemp, workers=1, backend='cpu'):
+    """
+    Returns a convolution plan for the given input dimensions, number of 
+    threads and backend, creating it on first use. On CPU, uses FFTW if
+    pyfftw is installed, scipy.fft otherwise. The lock attribute of the plan
+    must be held while using it.
+    """
+    check_backend(backend)
+    if backend == 'cupy':
+        return CupyPlan(nprof, n, ntemp, workers)
+    if pyfftw is not None:
+        return FFTWPlan(nprof, n, ntemp, workers)
+    return ScipyPlan(nprof, n, ntemp, workers)
+
+
+# pyfftw exports wisdom as a tuple of 3 strings of bytes, for double, single
+# and long double precision. They are plain text and stored in that order,
+# separated by a null byte.
+WISDOM_SEPARATOR = b'\0'
+
+
+def wisdom_path():
+    """
+    Path of the file where FFTW wisdom is stored. This can be set with the
+    environment variable SPYDEN_FFTW_WISDOM, and defaults to 
+    spyden/fftw_wisdom in the user cache directory.
+    """
+    path = os.environ.get('SPYDEN_FFTW_WISDOM')
+    if path:
+        return path
+    cache_dir = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_dir, 'spyden', 'fftw_wisdom')
+
+
+def load_wisdom(path=None):
+    """
+    Import FFTW wisdom from file. Does nothing if pyfftw is not installed.
+    Returns True if wisdom was successfully loaded, False otherwise.
+    """
+    if pyfftw is None:
+        return False
+
+    path = path or wisdom_path()
+    try:
+        with open(path, 'rb') as fobj:
+            wisdom = tuple(fobj.read().split(WISDOM_SEPARATOR))
+        if len(wisdom) != 3:
+            raise ValueError("not a valid FFTW wisdom file")
+        pyfftw.import_wisdom(wisdom)
+    except FileNotFoundError:
+        return False
+    except Exception as err:
+        log.warning("Failed to load FFTW wisdom from {!r}: {!s}".format(path, err))
+        return False
+    return True
+
+
+def save_wisdom(path=None):
+    """
+    Export FFTW wisdom to file, if any new FFTW plans have been created 
+    since wisdom was loaded. Does nothing if pyfftw is not installed.
+    Returns True if wisdom was successfully saved, False otherwise.
+    """
+    global _new_wisdom
+    if pyfftw is None or not _new_wisdom:
+        return False
+
+    # NOTE: many processes may save wisdom at the same time; write to a
+    # temporary file first and then atomically replace the output file
+    path = path or wisdom_path()
+    tmpname = None
+    try:
+        dirname = os.path.dirname(os.path.abspath(path))
+        os.makedirs(dirname, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=dirname, delete=False) as fobj:
+            tmpname = fobj.name
+            fobj.write(WISDOM_SEPARATOR.join(pyfftw.export_wisdom()))
+        os.replace(tmpname, path)
+    except Exception as err:
+        log.warning("Failed to save FFTW wisdom to {!r}: {!s}".format(path, err))
+        # Do not leave the temporary file behind
+        if tmpname is not None:
+            try:
+                os.remove(tmpname)
+            except OSError:
+                pass
+        return False
+
+    _new_wisdom = False
+    return True
+
+
+if pyfftw is not None:
+    load_wisdom()
+    atexit.register(save_wisdom)
@@ -0,0 +1,302 @@
+"""
+Compute kernels for the hot paths of snratio() and of the noise estimators.
+These are JIT-compiled with numba when it is installed, with a plain numpy
+implementation to fall back on otherwise.
+"""
+import functools
+import threading
+import contextlib
+
+import numpy as np
+
+try:
+    import numba
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+
+@contextlib.contextmanager
+def kernel_threads(workers):
+    """
+    Context manager that limits the number of threads used by the numba
+    kernels called from the current thread to 'workers', a positive int,
+    and restores the previous limit on exit. Does nothing if numba is not
+    installed.
+    """
+    if njit is None:
+        yield
+        return
+    # NOTE: the limit is local to the calling thread, and cannot exceed the
+    # size of the numba thread pool
+    previous = numba.get_num_threads()
+    numba.set_num_threads(min(workers, numba.config.NUMBA_NUM_THREADS))
+    try:
+        yield
+    finally:
+        numba.set_num_threads(previous)
+
+
+def kernel_input(x):
+    """
+    Returns x itself if its dtype can be read by the numba kernels, that is
+    integers, float32 or float64 in native byte order, otherwise a float64
+    copy of x (e.g. for float16 or big-endian input).
+    """
+    native = x.dtype.isnative
+    if native and (x.dtype.kind in 'iu' or x.dtype in (np.float32, np.float64)):
+        return x
+    return x.astype(np.float64)
+
+
+# Serialises calls to the numba kernels under numba's 'workqueue' threading
+# layer, the fallback when neither tbb nor OpenMP is available, which aborts
+# the process if parallel functions are called from several threads at once
+_WORKQUEUE_LOCK = threading.Lock()
+
+
+def _workqueue_layer():
+    """
+    Returns True if the numba kernels run on the 'workqueue' threading layer,
+    or if the layer is not known yet because no kernel has run so far.
+    """
+    try:
+        return numba.threading_layer() == 'workqueue'
+    except ValueError:
+        return True
+
+
+def _serialised(kernel):
+    """
+    Wrap a parallel numba kernel so that it is safe to call from several
+    threads, whatever the numba threading layer.
+    """
+    @functools.wraps(kernel)
+    def wrapper(*args):
+        if not _workqueue_layer():
+            return kernel(*args)
+        with _WORKQUEUE_LOCK:
+            return kernel(*args)
+    return wrapper
+
+
+def normalise_pad_numpy(x, mean, scale, out, left, right):
+    """
+    Subtract its mean from every line of x and multiply it by a scale factor,
+    and write the result, circularly padded to the length of the last axis
+    of 'out', into the pre-allocated array 'out'. Every output line contains,
+    in order:
+    - the p data bins
+    - the 'right' data bins that circularly follow the last data bin
+    - zeros
+    - the 'left' data bins that circularly precede the first data bin
+
+    Parameters
+    ----------
+    x: ndarray
+        2D input array with shape (nprof, p)
+    mean: ndarray
+        1D array with nprof elements
+    scale: ndarray
+        1D array with nprof elements
+    out: ndarray
+        2D output array with shape (nprof, n), where n >= p + left + right
+    left: int
+        Number of bins preceding the first data bin to write at the end of
+        each output line
+    right: int
+        Number of bins following the last data bin to write after it
+    """
+    p = x.shape[-1]
+    n = out.shape[-1]
+    # NOTE: write the normalised data directly into the output buffer
+    # without allocating any temporary array. The subtraction is computed
+    # in the precision of the inputs and cast to float32 only on output,
+    # so that data with a large offset do not lose precision.
+    data = out[:, :p]
+    np.subtract(x, mean.reshape(-1, 1), out=data, casting='unsafe')
+    np.multiply(data, scale.reshape(-1, 1), out=data, casting='unsafe')
+    # Padding wider than the data is rare, only then use fancy indexing
+    # which makes a temporary copy
+    if right <= p:
+        out[:, p:p + right] = out[:, :right]
+    else:
+        out[:, p:p + right] = out[:, np.arange(right) % p]
+    out[:, p + right:n - left] = 0.0
+    if left <= p:
+        out[:, n - left:] = out[:, p - left:p]
+    else:
+        out[:, n - left:] = out[:, np.arange(-left, 0) % p]
+
+
+def normalised_cumsum_numpy(x, mean, scale, out, left, right):
+    """
+    Subtract its mean from every line of x and multiply it by a scale factor,
+    extend it circularly with the 'left' bins that precede the first data
+    bin and the 'right' bins that follow the last data bin, and write the
+    cumulative sum of the result, preceded by a zero, into the pre-allocated
+    array 'out'.
+
+    Parameters
+    ----------
+    x: ndarray
+        2D input array with shape (nprof, p)
+    mean: ndarray
+        1D array with nprof elements
+    scale: ndarray
+        1D array with nprof elements
+    out: ndarray
+        2D float64 output array with shape (nprof, p + left + right + 1)
+    left: int
+        Number of bins preceding the first data bin
+    right: int
+        Number of bins following the last data bin
+    """
+    p = x.shape[-1]
+    cols = np.arange(-left, p + right) % p
+    xn = (x - mean.reshape(-1, 1)) * scale.reshape(-1, 1)
+    out[:, 0] = 0.0
+    np.cumsum(xn[:, cols], axis=-1, out=out[:, 1:])
+
+
+def moving_sums_numpy(csum, starts, stops, heights, out):
+    """
+    Compute the moving sums of the data along the last axis given their
+    cumulative sums, for a number of windows, and write them into the
+    pre-allocated array 'out', such that:
+    out[i, j, k] = (csum[i, stops[j] + k] - csum[i, starts[j] + k]) * heights[j]
+
+    Parameters
+    ----------
+    csum: ndarray
+        2D float64 array of cumulative sums, as written by normalised_cumsum()
+    starts, stops: ndarray
+        1D int arrays with the window start and end offsets
+    heights: ndarray
+        1D float array with the factors by which to multiply every window sum
+    out: ndarray
+        3D output array with shape (nprof, len(starts), p)
+    """
+    p = out.shape[-1]
+    for j in range(len(starts)):
+        a = starts[j]
+        b = stops[j]
+        np.subtract(csum[:, b:b + p], csum[:, a:a + p], out=out[:, j], casting='unsafe')
+        out[:, j] *= heights[j]
+
+
+def diffcov_std_numpy(x):
+    """
+    Returns the square root of minus the covariance of y[:-1] and y[1:],
+    where y are the consecutive differences of every line of x, with the
+    same normalisation as numpy.cov(). See noise_std_diffcov().
+
+    Parameters
+    ----------
+    x: ndarray
+        2D input array with shape (nprof, p)
+
+    Returns
+    -------
+    sigma: ndarray
+        1D array with nprof elements. NaN where the covariance is positive.
+    """
+    # Covariance of a = y[:-1] and b = y[1:] for all lines at once
+    y = np.diff(x, axis=-1)
+    a = y[:, :-1]
+    b = y[:, 1:]
+    m = a.shape[-1]
+    s = y.sum(axis=-1)
+    amean = (s - y[:, -1]) / m
+    bmean = (s - y[:, 0]) / m
+    ab = np.einsum('ij,ij->i', a, b)
+    cov = (ab - m * amean * bmean) / (m - 1)
+    return np.sqrt(-cov)
+
+
+if njit is not None:
+    @njit(parallel=True, cache=True)
+    def normalise_pad_numba(x, mean, scale, out, left, right):
+        nprof, p = x.shape
+        n = out.shape[1]
+        for i in prange(nprof):
+            m = np.float64(mean[i])
+            s = np.float64(scale[i])
+            # NOTE: subtract the mean in double precision, rounding the
+            # input to float32 first would lose the signal in data with a
+            # large offset
+            for j in range(p):
+                out[i, j] = (np.float64(x[i, j]) - m) * s
+            # Circular padding, in one pass over the output line
+            for j in range(p, p + right):
+                out[i, j] = out[i, j - p]
+            for j in range(p + right, n - left):
+                out[i, j] = 0.0
+            for j in range(n - left, n):
+                out[i, j] = out[i, (j - n) % p]
+
+    @njit(parallel=True, cache=True)
+    def normalised_cumsum_numba(x, mean, scale, out, left, right):
+        nprof, p = x.shape
+        n = out.shape[1] - 1
+        for i in prange(nprof):
+            m = np.float64(mean[i])
+            s = np.float64(scale[i])
+            acc = 0.0
+            out[i, 0] = 0.0
+            # Input bin that corresponds to output bin k, without modulo
+            j = (p - left % p) % p
+            for k in range(n):
+                acc += (np.float64(x[i, j]) - m) * s
+                out[i, k + 1] = acc
+                j += 1
+                if j == p:
+                    j = 0
+
+    @njit(parallel=True, cache=True)
+    def moving_sums_numba(csum, starts, stops, heights, out):
+        nprof, k, p = out.shape
+        for i in prange(nprof):
+            for j in range(k):
+                a = starts[j]
+                b = stops[j]
+                h = heights[j]
+                for q in range(p):
+                    out[i, j, q] = (csum[i, b + q] - csum[i, a + q]) * h
+
+    # NOTE: numpy error model so that degenerate inputs give inf or NaN
+    # like the numpy version, instead of raising ZeroDivisionError
+    @njit(parallel=True, cache=True, error_model='numpy')
+    def diffcov_std_numba(x):
+        nprof, p = x.shape
+        m = p - 2
+        out = np.empty(nprof)
+        for i in prange(nprof):
+            # Single pass over the line, without storing the differences
+            sa = 0.0
+            sb = 0.0
+            sab = 0.0
+            prev = np.float64(x[i, 1]) - np.float64(x[i, 0])
+            for j in range(2, p):
+                cur = np.float64(x[i, j]) - np.float64(x[i, j - 1])
+                sa += prev
+                sb += cur
+                sab += prev * cur
+                prev = cur
+            cov = (sab - sa * sb / m) / (m - 1)
+            out[i] = np.sqrt(-cov)
+        return out
+
+    normalise_pad = _serialised(normalise_pad_numba)
+    normalised_cumsum = _serialised(normalised_cumsum_numba)
+    moving_sums = _serialised(moving_sums_numba)
+    diffcov_std = _serialised(diffcov_std_numba)
+else:
+    normalise_pad_numba = None
+    normalise_pad = normalise_pad_numpy
+    normalised_cumsum_numba = None
+    normalised_cumsum = normalised_cumsum_numpy
+    moving_sums_numba = None
+    moving_sums = moving_sums_numpy
+    diffcov_std_numba = None
+    diffcov_std = diffcov_std_numpy
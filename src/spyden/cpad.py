@@ -1,5 +1,6 @@
 import logging
 import numpy as np
+import scipy.fft
 from numpy import ceil, log2
 
 
@@ -7,6 +8,48 @@ def ceilpow2(n):
     return 2 ** int(ceil(log2(n)))
 
 
+def next_fast_len(n):
+    """
+    Returns the smallest integer >= n whose only prime factors are 2, 3 and
+    5. FFTs of such lengths are computed efficiently by mixed-radix
+    algorithms, and can be much shorter than the next power of two.
+    """
+    # NOTE: this is what scipy.fft considers fast for real transforms
+    return scipy.fft.next_fast_len(n, real=True)
+
+
+def cpad_length(n, left, right):
+    """
+    Returns the length N to which input data with n bins must be circularly
+    padded, so that a circular convolution over N bins with a template that 
+    extends 'left' bins before and 'right' bins after its reference bin is
+    equal, on its first n bins, to the circular convolution over n bins.
+    The padded data are expected to contain the 'right' bins that circularly
+    follow the last data bin right after it, and the 'left' bins that 
+    circularly precede the first data bin at the very end, see 
+    spyden._kernels.normalise_pad().
+
+    This is n itself if n is an efficient FFT length, otherwise the next
+    efficient FFT length that can accommodate the template on both sides.
+
+    Parameters
+    ----------
+    n: int
+        Number of bins in the input data
+    left: int
+        Maximum number of template bins before the reference bin
+    right: int
+        Maximum number of template bins after the reference bin
+
+    Returns
+    -------
+    N: int
+    """
+    if next_fast_len(n) == n and left + right < n:
+        return n
+    return next_fast_len(n + left + right)
+
+
 def cpadpow2(x):
     """
     Circularly pad the last dimension of ndarray 'x' to a length that is a power of 2
@@ -1,15 +1,68 @@
 import numpy as np
 
+from spyden._kernels import kernel_input, diffcov_std
+
+
+def quartiles(x, overwrite_input=False):
+    """
+    Compute the first and third quartiles of the data along the last axis,
+    with the same linear interpolation as numpy.percentile(). Only a partial
+    sort of the data is performed, which is O(n) instead of O(n log n).
+
+    Parameters
+    ----------
+    x: ndarray
+        Input data, with shape (k_1, ..., k_n)
+    overwrite_input: bool, optional
+        If True, partially sort the input array in place instead of a copy,
+        and leave it in an undefined order (default: False)
+
+    Returns
+    -------
+    q1, q3: float or ndarray
+        First and third quartiles, with shape (k_1, ..., k_n-1)
+    """
+    n = x.shape[-1]
+    k = np.array([0.25, 0.75]) * (n - 1)
+    lo = np.floor(k).astype(int)
+    frac = k - lo
+    # NOTE: when a quantile falls exactly on a data point, there is nothing
+    # to interpolate and its upper neighbour need not be selected
+    hi = np.where(frac > 0, lo + 1, lo)
+
+    # After partitioning, the elements at all indices in 'kth' are those
+    # that would be found at the same indices in the fully sorted array
+    kth = np.unique(np.concatenate([lo, hi]))
+    if overwrite_input:
+        part = x
+        part.partition(kth, axis=-1)
+    else:
+        part = np.partition(x, kth, axis=-1)
+    a = part[..., lo]
+    b = part[..., hi]
+    q = a + (b - a) * frac
+    return q[..., 0], q[..., 1]
+
 
 def noise_std_iqr(x):
     """ 
     Estimate white noise standard deviation from the inter-quartile range of 
     the data. Robust to outliers but NOT red noise.
     """
+    # Partitioning requires a copy of the data anyway. Make it float32 only
+    # if the input can be cast to float32 exactly, which halves memory
+    # traffic compared to float64 input. Otherwise keep double precision:
+    # float32 rounding of data with a large offset would swamp the noise,
+    # and any single sample may be an outlier, so there is no safe way to
+    # remove the offset before the cast.
+    x = np.asarray(x)
+    dtype = np.float32 if np.can_cast(x.dtype, np.float32) else np.float64
+    y = x.astype(dtype)
+
     # If data is of shape (k_1, ..., k_n)
-    # stats has shape (num_percentiles, k_1, ..., k_n-1)
-    stats = np.percentile(x, (25, 75), axis=-1)
-    sigma = (stats[1] - stats[0]) / 1.3489795003921634
+    # quartiles have shape (k_1, ..., k_n-1)
+    q1, q3 = quartiles(y, overwrite_input=True)
+    sigma = (q3 - q1) / 1.3489795003921634
     return sigma
 
 
@@ -29,18 +82,14 @@ def noise_std_diffcov(x):
     between consecutive samples of that process is normally distributed
     with zero mean and variance s_r^2.
     """
-    def func(line):
-        y = np.diff(line)
-        c = np.cov(y[:-1], y[1:])
-        sw2 = -c[0, 1]
-        return sw2 ** 0.5
+    if not x.ndim in (1, 2):
+        raise ValueError("input must be 1D or 2D")
 
+    # NOTE: numba kernels cannot read all dtypes, e.g. float16
+    sigma = diffcov_std(kernel_input(x.reshape(-1, x.shape[-1])))
     if x.ndim == 1:
-        return func(x)
-    elif x.ndim == 2:
-        return np.asarray([func(line) for line in x])
-    else:
-        raise ValueError("input must be 1D or 2D")
+        return sigma[0]
+    return sigma
 
 
 def noise_mean_median(x):
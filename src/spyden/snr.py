@@ -1,9 +1,94 @@
+import os
+
 import numpy as np
 from spyden import noise_mean, noise_std, Template, TemplateBank
-from spyden.cpad import cpadpow2
+from spyden.cpad import cpad_length
+from spyden._fft import get_plan, num_workers, check_backend
+from spyden._kernels import kernel_input, kernel_threads, normalise_pad, normalised_cumsum, moving_sums
+
+
+def _normalisation_params(data, temp, mu, sigma, workers, backend):
+    """
+    Check the inputs of snratio() and snratio_reduce(). Returns the data
+    reshaped to 2D, the noise mean and std of every profile as 1D arrays,
+    and the actual number of threads to use to compute FFTs and to run the
+    numba kernels.
+    """
+    if not isinstance(data, np.ndarray):
+        raise ValueError("data must be a numpy array")
+
+    if not data.ndim in (1, 2):
+        raise ValueError("data must be have 1 or 2 dimensions")
+
+    if not isinstance(temp, (Template, TemplateBank)):
+        raise ValueError("temp must be a Template or TemplateBank")
+
+    # NOTE: check these even if the templates end up not requiring FFTs
+    workers = num_workers(workers)
+    check_backend(backend)
+
+    p = data.shape[-1] # number of phase bins
+    x = data.reshape(-1, p) # reshape data to 2D if it is 1D
+    x = kernel_input(x)
+
+    # Get mean and std
+    # NOTE: make sure they are 1D arrays even when there is only one profile
+    with kernel_threads(workers):
+        mean = _noise_param(x, mu, noise_mean)
+        if mean is None:
+            raise ValueError("mu must be either a valid noise mean estimation method name, or a float")
+
+        std = _noise_param(x, sigma, noise_std)
+        if std is None:
+            raise ValueError("sigma must be either a valid noise stddev estimation method name, or a float")
+
+    return x, mean, std, workers
+
+
+def _noise_param(x, value, estimator):
+    """
+    Returns a noise parameter of every line of the 2D data x as a 1D array
+    with one element per line: either 'value' repeated if it is a float, or 
+    the output of estimator(x, method=value) if it is a method name. Returns
+    None if 'value' is of any other type.
+    """
+    if isinstance(value, float):
+        return np.full(len(x), value)
+    if isinstance(value, str):
+        return estimator(x, method=value)
+    return None
+
+
+def _padding_params(p, temp):
+    """
+    Returns the number of bins n to which input data with p bins must be 
+    circularly padded before being convolved with 'temp', and the numbers
+    of bins preceding and following the data to write in the padding. See
+    normalise_pad().
+    """
+    # The padded data must leave enough room for the templates on both
+    # sides of their reference bin, unless p is an efficient FFT length
+    # and no padding is required
+    left, right = _template_extent(temp)
+    n = cpad_length(p, left, right)
+    if n == p:
+        left = right = 0
+    return n, left, right
+
+
+def _template_extent(temp):
+    """
+    Returns the maximum numbers of template bins before and after the
+    reference bin, across all templates in 'temp'
+    """
+    # NOTE: use the cached packed arrays to avoid a loop over templates
+    __, refbins, sizes = temp._packed()
+    left = int(refbins.max())
+    right = int((sizes - 1 - refbins).max())
+    return left, right
 
 
-def snratio(data, temp, mu='median', sigma='iqr'):
+def snratio(data, temp, mu='median', sigma='iqr', workers=-1, backend='cpu'):
     """
     Compute the signal-to-noise ratio map of input data using one or multiple
     pulse templates. The background noise standard deviation is either 
@@ -25,6 +110,16 @@ def snratio(data, temp, mu='median', sigma='iqr'):
         deviation, or specify its value directly. See noise_std() for
         a description of the different methods.
         (default: 'iqr')
+    workers: int, optional
+        Maximum number of threads used to compute FFTs, and to run the
+        other compute kernels if numba is installed. Negative values
+        count back from the number of CPUs, -1 meaning all of them.
+        (default: -1)
+    backend: str, optional
+        Where to compute FFTs. Choices are:
+        'cpu': use FFTW if pyfftw is installed, scipy.fft otherwise
+        'cupy': use the GPU via cupy, which must be installed
+        (default: 'cpu')
 
     Returns
     -------
@@ -42,69 +137,311 @@ def snratio(data, temp, mu='median', sigma='iqr'):
         that of the template that maximizes S/N.
         This is an array with the same shape as 'data'
     """
-    if not isinstance(data, np.ndarray):
-        raise ValueError("data must be a numpy array")
+    x, mean, std, workers = _normalisation_params(data, temp, mu, sigma, workers, backend)
+    nprof, p = x.shape
+    ntemp = 1 if isinstance(temp, Template) else len(temp)
 
-    if not data.ndim in (1, 2):
-        raise ValueError("data must be have 1 or 2 dimensions")
+    # NOTE: boxcars and other constant templates do not need FFTs at all
+    with kernel_threads(workers):
+        if _has_constant_data(temp):
+            csum, starts, stops, heights = _moving_sum_params(x, mean, std, temp)
+            snr = np.empty((nprof, ntemp, p), dtype=np.float32)
+            moving_sums(csum, starts, stops, heights, snr)
+        else:
+            # this does padding to right number of bins
+            # and the correct time-reversal of templates, and is cached by 'temp'
+            n, left, right = _padding_params(p, temp)
+            fy = temp.rfft_prepared(n).reshape(ntemp, -1)
+            snr = _snratio_impl(x, mean, std, fy, n, left, right, workers, backend)
 
-    if not isinstance(temp, (Template, TemplateBank)):
-        raise ValueError("temp must be a Template or TemplateBank")
+    ### Models
+    # Best template and phase bin of all profiles at once
+    flat = snr.reshape(nprof, -1)
+    best = flat.argmax(axis=-1)
+    itemp, ibin = np.unravel_index(best, (ntemp, p))
+    best_snr = flat[np.arange(nprof), best]
 
-    p = data.shape[-1] # number of phase bins
-    x = data.reshape(-1, p) # reshape data to 2D if it is 1D
+    models = _best_fit_models(temp, p, mean, std, best_snr, itemp, ibin)
+    return snr, mean, std, models
 
-    nprof = x.shape[0]
-    ntemp = 1 if isinstance(temp, Template) else len(temp)
 
-    # Get mean and std
-    # NOTE: make sure they are 1D arrays even when there is only one profile
-    if isinstance(mu, float):
-        mean = np.full(nprof, mu)
-    elif isinstance(mu, str):
-        mean = noise_mean(data, method=mu).reshape(nprof)
-    else:
-        raise ValueError("mu must be either a valid noise mean estimation method name, or a float")
+def _snratio_impl(x, mean, std, fy, n, left, right, workers=1, backend='cpu'):
+    """
+    Compute the S/N map of snratio() from already validated inputs, without
+    any further checks.
 
-    if isinstance(sigma, float):
-        std = np.full(nprof, sigma)
-    elif isinstance(sigma, str):
-        std = noise_std(data, method=sigma).reshape(nprof)
-    else:
-        raise ValueError("sigma must be either a valid noise stddev estimation method name, or a float")
+    Parameters
+    ----------
+    x: ndarray
+        2D input data with shape (nprof, p)
+    mean: ndarray
+        1D array of noise means with nprof elements
+    std: ndarray
+        1D array of noise standard deviations with nprof elements
+    fy: ndarray
+        rFFT of the templates prepared for n bins, as a complex64 array with 
+        shape (ntemp, n // 2 + 1)
+    n, left, right: int
+        Padding parameters, as returned by _padding_params()
+    workers: int
+        Number of threads used to compute FFTs, must be positive
+    backend: str
+        Where to compute FFTs, see snratio()
+
+    Returns
+    -------
+    snr: ndarray
+        S/N map with shape (nprof, ntemp, p)
+    """
+    nprof, p = x.shape
+    ntemp = fy.shape[0]
 
-    ### Normalise and pad input
-    x = (x - mean.reshape(-1, 1)) / std.reshape(-1, 1)
-    x = cpadpow2(x).astype(np.float32)
+    # Write the un-padded output of each block of templates directly into
+    # the S/N map. Peak memory usage is then that of the S/N map plus a 
+    # bounded amount for the plan work buffers, rather than that of the
+    # full padded convolution output.
+    snr = np.empty((nprof, ntemp, p), dtype=np.float32)
+    for start, conv in _convolved_blocks(x, mean, std, fy, n, left, right, workers, backend):
+        snr[:, start:start + conv.shape[1]] = conv
+    return snr
 
-    ### Get S/N using circular convolution theorem
-    fx = np.fft.rfft(x).reshape(nprof, 1, -1)
 
-    # this does padding to right number of bins
-    # and the correct time-reversal of templates
-    y = temp.prepared_data(x.shape[-1]).astype(np.float32)
-    fy = np.fft.rfft(y).reshape(1, ntemp, -1)
-    snr = np.fft.irfft(fx * fy)
+def _convolved_blocks(x, mean, std, fy, n, left, right, workers, backend):
+    """
+    Generator that convolves the normalised data with blocks of templates
+    at a time, and yields for every block a tuple (start, conv), where
+    'start' is the index of the first template of the block and 'conv' the
+    S/N map of the block with shape (nprof, k, p), for k templates. See
+    _snratio_impl() for a description of the parameters.
+
+    NOTE: 'conv' is a view into the plan work buffers, which is only valid
+    until the next block is requested. The plan lock is held until the
+    generator is exhausted or closed.
+    """
+    nprof, p = x.shape
+    ntemp = fy.shape[0]
 
-    # Un-pad
-    snr = snr[:, :, :p]
+    # Normalise the data to unit variance, and also divide by n since plans
+    # do not normalise their inverse FFTs
+    scale = 1.0 / (n * std)
 
-    ### Models
-    models = np.zeros(shape=(nprof, p))
+    block, fy = _template_blocks(nprof, n, fy, _work_buffer_limit(backend))
+    plan = get_plan(nprof, n, block, workers, backend)
+    with plan.lock:
+        normalise_pad(x, mean, scale, plan.x, left, right)
+        plan.forward()
+        for start in range(0, ntemp, block):
+            stop = min(start + block, ntemp)
+            conv = plan.convolve(fy[start:start+block])
+            yield start, conv[:, :stop - start, :p]
 
-    for iprof in range(nprof):
-        snr_plane = snr[iprof]
-        itemp, ibin = np.unravel_index(snr_plane.argmax(), snr_plane.shape)
-        best_snr = snr_plane[itemp, ibin]
 
-        if isinstance(temp, TemplateBank):
-            best_template = temp[itemp]
+def _has_constant_data(temp):
+    """
+    Returns True if all the data bins of the template(s) 'temp' have the 
+    same value, which is the case for boxcars
+    """
+    data, __, sizes = temp._packed()
+    # NOTE: ignore the zero padding of the packed data
+    inside = np.arange(data.shape[-1]) < sizes.reshape(-1, 1)
+    return bool(np.all((data == data[:, :1]) | ~inside))
+
+
+def _moving_sum_params(x, mean, std, temp):
+    """
+    For template(s) with constant data, the circular convolution with every
+    template is a moving sum of the normalised data, which is computed as
+    the difference of two cumulative sums in O(nprof * p) operations 
+    whatever the template size. Returns the cumulative sums and the window
+    parameters to pass to moving_sums() to get the S/N map.
+    """
+    nprof, p = x.shape
+    data, refbins, sizes = temp._packed()
+    left, right = _template_extent(temp)
+
+    # NOTE: accumulate in double precision to avoid any loss of accuracy
+    # at the end of long profiles
+    csum = np.empty((nprof, p + left + right + 1))
+    normalised_cumsum(x, mean, 1.0 / std, csum, left, right)
+
+    # S/N at bin i is the sum of the normalised data over bins i - refbin
+    # to i - refbin + size - 1, times the template value
+    starts = left - refbins
+    stops = starts + sizes
+    # NOTE: a contiguous float64 copy is measurably faster in the kernel
+    # than a strided float32 view
+    heights = data[:, 0].astype(float)
+    return csum, starts, stops, heights
+
+
+def _l2_cache_bytes():
+    """
+    Size in bytes of the L2 cache of one CPU core, or 1 MiB if it cannot be
+    determined on this platform.
+    """
+    try:
+        size = os.sysconf('SC_LEVEL2_CACHE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        size = 0
+    return size if size > 0 else 2**20
+
+
+# Maximum memory size in bytes of the work buffers of the plans used to
+# convolve a block of templates
+WORK_BUFFER_BYTES = 64 * 2**20
+
+L2_CACHE_BYTES = _l2_cache_bytes()
+
+
+def _work_buffer_limit(backend):
+    """
+    Maximum memory size in bytes of the plan work buffers for one block of
+    templates. On CPU, blocks are also sized to fit in L2 cache if possible.
+    """
+    if backend == 'cpu':
+        return min(WORK_BUFFER_BYTES, L2_CACHE_BYTES)
+    return WORK_BUFFER_BYTES
+
+
+def _template_blocks(nprof, n, fy, maxbytes):
+    """
+    Split the templates into blocks of equal size to be convolved one after
+    the other, such that the plan work buffers for one block do not exceed
+    'maxbytes', unless a block has only one template. Returns the block 
+    size, and the rFFT of the templates 'fy' zero-padded with extra rows to
+    a whole number of blocks if needed.
+    """
+    ntemp, nc = fy.shape
+    # float32 convolution output and complex64 product for every template
+    nbytes = nprof * (4 * n + 8 * nc)
+    maxblock = max(1, maxbytes // nbytes)
+    # NOTE: choose the smallest block size that gives the same number of
+    # blocks, which minimises the number of padding rows
+    nblocks = -(-ntemp // maxblock)
+    block = -(-ntemp // nblocks)
+
+    extra = nblocks * block - ntemp
+    if extra:
+        fy = np.concatenate([fy, np.zeros((extra, nc), dtype=fy.dtype)])
+    return block, fy
+
+
+def _best_fit_models(temp, p, mean, std, snr, itemp, ibin):
+    """
+    Returns the best-fit noise-free pulse model of every profile, given
+    the best S/N, template index and phase bin index found for each of them,
+    as a 2D array with shape (nprof, p)
+    """
+    data, refbins, __ = temp._packed()
+
+    # Gather the best template of every profile, scaled to its amplitude.
+    # Template bin j lands on phase bin (ibin - refbin + j) mod p
+    nprof = len(snr)
+    size = data.shape[-1]
+    values = data[itemp] * (std * snr).reshape(-1, 1)
+    rows = np.arange(nprof).reshape(-1, 1)
+    cols = ((ibin - refbins[itemp]).reshape(-1, 1) + np.arange(size)) % p
+
+    models = np.empty(shape=(nprof, p))
+    models[:] = mean.reshape(-1, 1)
+    # NOTE: templates longer than the data wrap onto themselves, and repeated
+    # indices must then be accumulated with the slower np.add.at()
+    if size <= p:
+        models[rows, cols] += values
+    else:
+        np.add.at(models, (rows, cols), values)
+    return models
+
+
+def snratio_reduce(data, temp, mu='median', sigma='iqr', workers=-1, backend='cpu'):
+    """
+    Compute the best signal-to-noise ratio of every input profile, across
+    all templates and phase bins, along with the parameters of the best-fit
+    pulse. This gives the same results as finding the maximum of the S/N map
+    returned by snratio() for every profile, but the S/N map is never 
+    stored in full: templates are processed in blocks that fit in cache,
+    and the memory usage does not grow with the number of templates.
+
+    Parameters
+    ----------
+    data: ndarray
+        Array of single pulses 1-D or 2-D. Last dimension must be phase.
+    temp: Template or TemplateBank
+        Noise-free pulse template(s)
+    mu: str or float, optional
+        Either the method name to evaluate the background noise mean, or
+        specify its value directly. See snratio().
+    sigma: str or float, optional
+        Either the method name to evaluate the background noise standard 
+        deviation, or specify its value directly. See snratio().
+    workers: int, optional
+        Maximum number of threads used to compute FFTs, and to run the
+        other compute kernels if numba is installed. See snratio().
+    backend: str, optional
+        Where to compute FFTs. See snratio().
+
+    Returns
+    -------
+    snr: ndarray
+        The best S/N of every profile, as a 1-D array
+    itemp: ndarray
+        Index of the template that maximizes S/N for every profile
+    ibin: ndarray
+        Phase bin index with which the reference bin of the best template
+        must be lined up, for every profile
+    mean: ndarray
+        The mean of every profile
+    std: ndarray
+        The estimated white noise standard deviation for every profile
+    models: ndarray
+        For each profile, the best-fit noise-free pulse model. See snratio().
+    """
+    x, mean, std, workers = _normalisation_params(data, temp, mu, sigma, workers, backend)
+    nprof, p = x.shape
+    ntemp = 1 if isinstance(temp, Template) else len(temp)
+
+    # Running best S/N and best-fit parameters of every profile
+    snr = np.full(nprof, -np.inf, dtype=np.float32)
+    itemp = np.zeros(nprof, dtype=int)
+    ibin = np.zeros(nprof, dtype=int)
+
+    with kernel_threads(workers):
+        if _has_constant_data(temp):
+            csum, starts, stops, heights = _moving_sum_params(x, mean, std, temp)
+            # Blocks of templates whose S/N map fits in the same memory as the
+            # plan work buffers of the FFT path
+            block = max(1, _work_buffer_limit(backend) // (4 * nprof * p))
+            out = np.empty((nprof, min(block, ntemp), p), dtype=np.float32)
+            for start in range(0, ntemp, block):
+                stop = min(start + block, ntemp)
+                conv = out[:, :stop - start]
+                moving_sums(csum, starts[start:stop], stops[start:stop], heights[start:stop], conv)
+                _update_best(conv, start, snr, itemp, ibin)
         else:
-            best_template = temp
-
-        models[iprof] = mean[iprof]
-        models[iprof, :best_template.size] += best_template.data * std[iprof] * best_snr
-        shift = ibin - best_template.refbin
-        models[iprof] = np.roll(models[iprof], shift)
-    
-    return snr, mean, std, models
\ No newline at end of file
+            n, left, right = _padding_params(p, temp)
+            fy = temp.rfft_prepared(n).reshape(ntemp, -1)
+            for start, conv in _convolved_blocks(x, mean, std, fy, n, left, right, workers, backend):
+                _update_best(conv, start, snr, itemp, ibin)
+
+    models = _best_fit_models(temp, p, mean, std, snr, itemp, ibin)
+    return snr, itemp, ibin, mean, std, models
+
+
+def _update_best(conv, start, snr, itemp, ibin):
+    """
+    Update in place the running best S/N, template index and phase bin of
+    every profile, given the S/N map 'conv' with shape (nprof, k, p) of the
+    block of k templates that starts at template index 'start'.
+    """
+    nprof, __, p = conv.shape
+    # Best template and bin in the block, in the same order as in
+    # snratio(); the copy made by reshape() is cheap in comparison
+    flat = conv.reshape(nprof, -1)
+    best = flat.argmax(axis=-1)
+    bsnr = flat[np.arange(nprof), best]
+    # NOTE: strict inequality so that ties are resolved like in
+    # snratio(), in favour of the first template
+    better = bsnr > snr
+    snr[better] = bsnr[better]
+    itemp[better] = start + best[better] // p
+    ibin[better] = best[better] % p
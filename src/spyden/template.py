@@ -1,5 +1,7 @@
+from collections import OrderedDict
+
 import numpy as np
-import matplotlib.pyplot as plt
+import scipy.fft
 from numpy import log, pi, sin, sqrt, ceil, exp
 
 
@@ -19,6 +21,49 @@ def normalise(data):
     return data * sqsum**-0.5
 
 
+def _check_padded_length(n, size):
+    """ Raise ValueError if template data with given size cannot be padded to n bins """
+    if not n >= size:
+        msg = ("Cannot pad template data to length n = {}; this "
+            "is shorter than the template size ({}). You are probably "
+            "trying to use this template on data that is too short.")
+        msg = msg.format(n, size)
+        raise ValueError(msg)
+
+
+# Maximum number of padded lengths for which every Template and TemplateBank
+# keeps the FFT of its prepared data in memory
+RFFT_CACHE_SIZE = 8
+
+
+def _lru_cached(cache, key, func, maxsize):
+    """ 
+    Returns cache[key] if present, otherwise computes func() and stores it
+    in the OrderedDict 'cache', evicting the least recently used entry if 
+    the cache then holds more than 'maxsize' items.
+    """
+    if key in cache:
+        cache.move_to_end(key)
+        return cache[key]
+    value = cache[key] = func()
+    if len(cache) > maxsize:
+        cache.popitem(last=False)
+    return value
+
+
+def _readonly_rfft(x):
+    """ 
+    rFFT along the last axis of x, cast to complex64 and made read-only. 
+    All lines of x are transformed in a single batched call.
+    NOTE: this is a small transform computed once per padded length, use a
+    single thread so that the 'workers' limit passed to snratio() is never
+    exceeded, e.g. when running in a multiprocessing pool.
+    """
+    fx = scipy.fft.rfft(x, axis=-1).astype(np.complex64, copy=False)
+    fx.setflags(write=False)
+    return fx
+
+
 class Template(object):
     """ 
     Create a noise-free pulse template of arbitrary shape from a numpy array.
@@ -72,6 +117,9 @@ class Template(object):
         self._reference = str(reference)
         self._kind = str(kind)
         self._shape_params = dict(shape_params)
+        self._reversed_offsets = self._refbin - np.arange(self.size)
+        self._fy_cache = OrderedDict()
+        self._packed_cache = None
 
     @property
     def data(self):
@@ -115,7 +163,8 @@ class Template(object):
         ----------
         n: int
             The total length to which the template must be padded. This will
-            generally be a power of two to compute FFTs faster.
+            generally have only 2, 3 and 5 as prime factors to compute FFTs 
+            faster, see spyden.cpad.cpad_length().
 
         Raises
         ------
@@ -123,30 +172,44 @@ class Template(object):
         """
         # NOTE: normalisation to unit square sum must be done BEFORE padding !
 
-        if not n >= self.size:
-            msg = ("Cannot pad template data to length n = {}; this "
-                "is shorter than the template size ({}). You are probably "
-                "trying to use this template on data that is too short.")
-            msg = msg.format(n, self.size)
-            raise ValueError(msg)
-
-        # Zero-pad to a total of n bins
-        # NOTE: padding has to be done on the right side so that 'refbin'
-        # stays the same !
-        x = np.pad(
-            self.data, 
-            (0, n - self.size), # pad on right size up to length n
-            mode='constant', 
-            constant_values=(0.0, 0.0))
-
-        # Place reference bin at index 0
-        x = np.roll(x, -self.refbin)
-
-        # We want to get the array y such that: y[k] = x[-k]
-        # NOTE: this is NOT like reversing the array
-        # since y[0] = x[0]
-        x = np.roll(x[::-1], 1)
-        return x.astype(np.float32)
+        _check_padded_length(n, self.size)
+
+        # If x is the template data zero-padded on the right to n bins, and
+        # then rolled to place the reference bin at index 0, we want to get 
+        # the array y such that: y[k] = x[-k]
+        # NOTE: this is NOT like reversing the array since y[0] = x[0]
+        # Data bin j ends up at index (refbin - j) mod n, and the whole
+        # operation is done with a single scatter into a zeroed array
+        y = np.zeros(n, dtype=np.float32)
+        y[self._reversed_offsets % n] = self.data
+        return y
+
+    def _packed(self):
+        """
+        Same as TemplateBank._packed(), for a bank made of this template 
+        only: returns the template data as a float32 array with shape 
+        (1, size), and the arrays of reference bins and sizes. The result is
+        cached.
+        """
+        if self._packed_cache is None:
+            data = self.data.astype(np.float32).reshape(1, -1)
+            self._packed_cache = (data, np.asarray([self.refbin]), np.asarray([self.size]))
+        return self._packed_cache
+
+    def rfft_prepared(self, n):
+        """
+        Returns the rFFT of prepared_data(n) as a complex64 array. The result
+        is cached, and the returned array is read-only.
+
+        Parameters
+        ----------
+        n: int
+            The total length to which the template must be padded.
+        """
+        return _lru_cached(
+            self._fy_cache, n, 
+            lambda: _readonly_rfft(self.prepared_data(n)),
+            RFFT_CACHE_SIZE)
 
     @classmethod
     def boxcar(cls, w):
@@ -215,6 +278,10 @@ class Template(object):
         -------
         fig: matplotlib.Figure
         """
+        # NOTE: import here, matplotlib is slow to import and uses a lot of
+        # memory, which is wasted in processes that never make plots
+        import matplotlib.pyplot as plt
+
         fig = plt.figure(figsize=(6, 4.5), dpi=dpi)
         plt.bar(range(self.size), self.data, width=0.9, color='#b3b3b3')
 
@@ -266,6 +333,36 @@ class TemplateBank(list):
             raise ValueError("All input elements must be of Template instances")
 
         super(TemplateBank, self).__init__(templates)
+        self._cache = {}
+        self._fy_cache = OrderedDict()
+
+    def _cached(self, key, func):
+        """
+        Returns func(), computed only once and cached under 'key'.
+        """
+        # NOTE: a TemplateBank is a list and may be modified after creation;
+        # a cached result is only valid for the exact same Template objects
+        templates = tuple(self)
+        entry = self._cache.get(key)
+        if entry is None or entry[0] != templates:
+            entry = self._cache[key] = (templates, func())
+        return entry[1]
+
+    def _packed(self):
+        """
+        Returns the data of all templates packed into a single contiguous
+        float32 array with shape (num_templates, maxsize), where each line is
+        zero-padded on the right, and the arrays of template reference bins
+        and sizes. The result is cached.
+        """
+        def pack():
+            data = np.zeros((len(self), self.maxsize), dtype=np.float32)
+            for i, t in enumerate(self):
+                data[i, :t.size] = t.data
+            refbins = np.asarray([t.refbin for t in self])
+            sizes = np.asarray([t.size for t in self])
+            return data, refbins, sizes
+        return self._cached('packed', pack)
 
     @property
     def maxsize(self):
@@ -322,4 +419,29 @@ class TemplateBank(list):
         with some input data with n bins. The output is a 2D array. See
         Template.prepared_data() for details.
         """
-        return np.asarray([t.prepared_data(n) for t in self])
+        data, refbins, __ = self._packed()
+        ntemp, maxsize = data.shape
+        _check_padded_length(n, maxsize)
+
+        # Same single scatter as in Template.prepared_data(), for all 
+        # templates at once. The zero padding of the packed data lands on
+        # bins that are zero anyway.
+        y = np.zeros((ntemp, n), dtype=np.float32)
+        rows = np.arange(ntemp).reshape(-1, 1)
+        cols = (refbins.reshape(-1, 1) - np.arange(maxsize)) % n
+        y[rows, cols] = data
+        return y
+
+    def rfft_prepared(self, n):
+        """
+        Returns the rFFT of prepared_data(n) as a complex64 array with shape
+        (num_templates, n // 2 + 1). The result is cached, and the returned 
+        array is read-only.
+        """
+        # NOTE: see _cached() regarding modifications of the bank
+        templates = tuple(self)
+        compute = lambda: (templates, _readonly_rfft(self.prepared_data(n)))
+        entry = _lru_cached(self._fy_cache, n, compute, RFFT_CACHE_SIZE)
+        if entry[0] != templates:
+            entry = self._fy_cache[n] = compute()
+        return entry[1]
@@ -0,0 +1,14 @@
+import os
+import atexit
+import shutil
+import tempfile
+
+# NOTE: spyden saves FFTW wisdom to the user cache directory on exit when
+# pyfftw is installed; redirect it to a temporary directory so that running
+# the tests leaves the user's wisdom file untouched. This must be done before
+# spyden is first imported, since it loads wisdom on import.
+_wisdom_dir = tempfile.mkdtemp(prefix='spyden-tests-')
+os.environ['SPYDEN_FFTW_WISDOM'] = os.path.join(_wisdom_dir, 'fftw_wisdom')
+
+# Registered before spyden saves wisdom at exit, hence runs after it
+atexit.register(shutil.rmtree, _wisdom_dir, ignore_errors=True)
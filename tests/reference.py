@@ -0,0 +1,32 @@
+"""
+Slow but straightforward reference implementations, to compare against
+the outputs of spyden in the tests.
+"""
+import numpy as np
+
+
+def circular_convolution(data, temp):
+    """
+    S/N of every line of the 2D array 'data', normalised to zero mean and
+    unit variance, with the Template 'temp' at every phase bin, computed as
+    a direct circular convolution. Returns an array with the same shape as
+    'data'.
+    """
+    size = data.shape[-1]
+    k = np.arange(temp.size) - temp.refbin
+    return np.asarray([
+        [(line[(i + k) % size] * temp.data).sum() for i in range(size)]
+        for line in data
+    ])
+
+
+def diffcov_std(data):
+    """
+    Noise standard deviation of every line of the 2D array 'data', estimated
+    from the covariance of consecutive differences with numpy.cov()
+    """
+    sigma = []
+    for line in data:
+        y = np.diff(line)
+        sigma.append((-np.cov(y[:-1], y[1:])[0, 1]) ** 0.5)
+    return np.asarray(sigma)
@@ -1,7 +1,7 @@
 import unittest
 import numpy as np
 
-from spyden.cpad import cpadpow2
+from spyden.cpad import cpadpow2, next_fast_len, cpad_length
 
 
 class TestCpadpow2(unittest.TestCase):
@@ -37,3 +37,28 @@ class TestCpadpow2(unittest.TestCase):
         xp = cpadpow2(x)
         self.assertEqual(xp.shape, y.shape)
         self.assertTrue(np.allclose(xp, y))
+
+
+def is_5smooth(n):
+    for f in (2, 3, 5):
+        while n % f == 0:
+            n //= f
+    return n == 1
+
+
+class TestNextFastLen(unittest.TestCase):
+    """ """
+    def test_next_fast_len(self):
+        expected = 1
+        for n in range(1, 1025):
+            while not is_5smooth(expected) or expected < n:
+                expected += 1
+            self.assertEqual(next_fast_len(n), expected)
+
+    def test_cpad_length(self):
+        # Efficient length, no padding required
+        self.assertEqual(cpad_length(100, 3, 4), 100)
+        # Template longer than the data
+        self.assertEqual(cpad_length(100, 50, 50), 200)
+        # Prime length
+        self.assertEqual(cpad_length(97, 3, 4), 108)
@@ -0,0 +1,112 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+
+from spyden import _fft
+from spyden._fft import aligned_empty, ScipyPlan, FFTWPlan, CupyPlan, get_plan, num_workers, load_wisdom, save_wisdom
+
+
+class TestPlans(unittest.TestCase):
+    """ """
+    def setUp(self):
+        nprof, n, ntemp = (3, 32, 4)
+        rng = np.random.default_rng(0)
+        self.x = rng.normal(size=(nprof, n)).astype(np.float32)
+        y = rng.normal(size=(ntemp, n)).astype(np.float32)
+        self.fy = np.fft.rfft(y).astype(np.complex64)
+
+        # Reference: direct circular convolution
+        k = np.arange(n)
+        self.expected = np.asarray([
+            [
+                [(xi * yj[(j - k) % n]).sum() for j in range(n)]
+                for yj in y
+            ]
+            for xi in self.x
+        ])
+
+    def check_plan(self, plan):
+        plan.x[:] = self.x
+        plan.forward()
+        self.assertEqual(plan.fx.dtype, np.complex64)
+        out = plan.convolve(self.fy)
+        self.assertEqual(out.shape, self.expected.shape)
+        self.assertEqual(out.dtype, np.float32)
+        # NOTE: output is not normalised by the number of bins
+        n = self.x.shape[-1]
+        self.assertTrue(np.allclose(out / n, self.expected, atol=1e-4))
+
+    def test_scipy_plan(self):
+        self.check_plan(ScipyPlan(3, 32, 4, 2))
+
+    @unittest.skipIf(_fft.pyfftw is None, "pyfftw not installed")
+    def test_fftw_plan(self):
+        self.check_plan(FFTWPlan(3, 32, 4, 2))
+
+    @unittest.skipIf(_fft.cupy is None, "cupy not installed")
+    def test_cupy_plan(self):
+        self.check_plan(CupyPlan(3, 32, 4, 1))
+
+    def test_backend(self):
+        with self.assertRaises(ValueError):
+            get_plan(3, 32, 4, 1, 'gpu')
+        if _fft.cupy is None:
+            with self.assertRaises(ValueError):
+                get_plan(3, 32, 4, 1, 'cupy')
+        else:
+            self.assertIsInstance(get_plan(3, 32, 4, 1, 'cupy'), CupyPlan)
+
+    def test_aligned_empty(self):
+        for shape, dtype in [((3, 5), np.float32), ((2, 3, 17), np.complex64), (7, np.float64)]:
+            x = aligned_empty(shape, dtype)
+            self.assertEqual(x.shape, np.empty(shape).shape)
+            self.assertEqual(x.dtype, dtype)
+            self.assertTrue(x.flags.c_contiguous)
+            self.assertEqual(x.ctypes.data % 64, 0)
+
+        plan = ScipyPlan(3, 32, 4, 1)
+        self.assertEqual(plan.x.ctypes.data % 64, 0)
+        self.assertEqual(plan.prod.ctypes.data % 64, 0)
+
+    def test_get_plan_cached(self):
+        self.assertIs(get_plan(3, 32, 4), get_plan(3, 32, 4))
+        self.assertIsNot(get_plan(3, 32, 4, 1), get_plan(3, 32, 4, 2))
+
+    def test_num_workers(self):
+        ncpu = os.cpu_count()
+        self.assertEqual(num_workers(1), 1)
+        self.assertEqual(num_workers(-1), ncpu)
+        self.assertEqual(num_workers(-ncpu), 1)
+        self.assertEqual(num_workers(np.int64(1)), 1)
+        self.assertIs(type(num_workers(np.int32(1))), int)
+        for workers in (0, -ncpu - 1, 1.0, True, np.bool_(True), '1'):
+            with self.assertRaises(ValueError):
+                num_workers(workers)
+
+    @unittest.skipIf(_fft.pyfftw is None, "pyfftw not installed")
+    def test_wisdom(self):
+        FFTWPlan(2, 24, 3, 1)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'subdir', 'wisdom')
+            self.assertFalse(load_wisdom(path))
+            self.assertTrue(save_wisdom(path))
+            self.assertTrue(os.path.isfile(path))
+            self.assertTrue(load_wisdom(path))
+            # Nothing new to save
+            self.assertFalse(save_wisdom(path))
+
+            # Not a wisdom file
+            with open(path, 'wb') as fobj:
+                fobj.write(b'garbage')
+            with self.assertLogs(_fft.log, level='WARNING'):
+                self.assertFalse(load_wisdom(path))
+
+            # Output path that cannot be replaced, and no temporary file
+            # left behind
+            FFTWPlan(2, 30, 3, 1)
+            dirname = os.path.join(tmpdir, 'dir')
+            os.makedirs(os.path.join(dirname, 'wisdom'))
+            with self.assertLogs(_fft.log, level='WARNING'):
+                self.assertFalse(save_wisdom(os.path.join(dirname, 'wisdom')))
+            self.assertEqual(os.listdir(dirname), ['wisdom'])
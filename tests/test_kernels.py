@@ -0,0 +1,153 @@
+import os
+import sys
+import unittest
+import subprocess
+import numpy as np
+
+from spyden._kernels import normalise_pad_numpy, normalise_pad_numba
+from spyden._kernels import diffcov_std_numpy, diffcov_std_numba
+from spyden._kernels import normalised_cumsum_numpy, normalised_cumsum_numba
+from spyden._kernels import moving_sums_numpy, moving_sums_numba
+from spyden.cpad import cpadpow2
+
+import reference
+
+
+class TestNormalisePad(unittest.TestCase):
+    """ """
+    def check(self, func):
+        nprof, p = (3, 13)
+        x = np.random.default_rng(0).normal(size=(nprof, p))
+        mean = x.mean(axis=-1)
+        std = x.std(axis=-1)
+        expected = cpadpow2((x - mean.reshape(-1, 1)) / std.reshape(-1, 1))
+
+        n = 16
+        out = np.empty((nprof, n), dtype=np.float32)
+        func(x, mean, 1.0 / std, out, 0, n - p)
+        self.assertTrue(np.allclose(out, expected, atol=1e-6))
+
+        # With bins preceding the start of the data at the end, and zeros
+        # in between
+        left, right = (2, 1)
+        func(x, mean, 1.0 / std, out, left, right)
+        self.assertTrue(np.allclose(out[:, :p+right], expected[:, :p+right], atol=1e-6))
+        self.assertTrue(np.all(out[:, p+right:-left] == 0))
+        self.assertTrue(np.allclose(out[:, -left:], expected[:, p-left:p], atol=1e-6))
+
+        # With padding wider than the data on both sides
+        left, right = (15, 17)
+        out = np.empty((nprof, 48), dtype=np.float32)
+        func(x, mean, 1.0 / std, out, left, right)
+        norm = expected[:, :p]
+        self.assertTrue(np.allclose(out[:, p:p+right], norm[:, np.arange(right) % p], atol=1e-6))
+        self.assertTrue(np.all(out[:, p+right:-left] == 0))
+        self.assertTrue(np.allclose(out[:, -left:], norm[:, np.arange(-left, 0) % p], atol=1e-6))
+
+    def check_offset(self, func):
+        """ Output must not lose precision on data with a large offset """
+        x = np.random.default_rng(0).normal(size=(3, 13))
+        n = 16
+        for offset in (1e6, 1e7, 1e9):
+            mean = np.full(3, offset)
+            scale = np.ones(3)
+            out = np.empty((3, n), dtype=np.float32)
+            func(x + offset, mean, scale, out, 0, n - 13)
+            self.assertTrue(np.allclose(out[:, :13], x, atol=1e-5))
+
+    def test_numpy(self):
+        self.check(normalise_pad_numpy)
+        self.check_offset(normalise_pad_numpy)
+
+    @unittest.skipIf(normalise_pad_numba is None, "numba not installed")
+    def test_numba(self):
+        self.check(normalise_pad_numba)
+        self.check_offset(normalise_pad_numba)
+
+
+class TestDiffcovStd(unittest.TestCase):
+    """ """
+    def check(self, func):
+        rng = np.random.default_rng(0)
+        x = rng.normal(size=(4, 100)) + np.linspace(0, 10, 100)
+        expected = reference.diffcov_std(x)
+
+        self.assertTrue(np.allclose(func(x), expected))
+        self.assertTrue(np.allclose(func(x.astype(np.float32)), expected, rtol=1e-4))
+
+    def test_numpy(self):
+        self.check(diffcov_std_numpy)
+
+    @unittest.skipIf(diffcov_std_numba is None, "numba not installed")
+    def test_numba(self):
+        self.check(diffcov_std_numba)
+
+
+class TestMovingSums(unittest.TestCase):
+    """ """
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.x = rng.normal(size=(3, 13)).astype(np.float32)
+        self.mean = rng.normal(size=3)
+        self.scale = rng.uniform(0.5, 2.0, size=3)
+
+    def check_cumsum(self, func):
+        x, mean, scale = self.x, self.mean, self.scale
+        p = x.shape[-1]
+        xn = (x - mean.reshape(-1, 1)) * scale.reshape(-1, 1)
+        # Extensions narrower and wider than the data
+        for left, right in [(0, 0), (2, 5), (15, 30)]:
+            out = np.empty((3, p + left + right + 1))
+            func(x, mean, scale, out, left, right)
+            cols = np.arange(-left, p + right) % p
+            expected = np.cumsum(xn[:, cols], axis=-1)
+            self.assertTrue(np.all(out[:, 0] == 0))
+            self.assertTrue(np.allclose(out[:, 1:], expected))
+
+    def check_moving_sums(self, func):
+        csum = np.cumsum(self.x.astype(float), axis=-1)
+        starts = np.asarray([0, 1, 3])
+        stops = np.asarray([1, 5, 8])
+        heights = np.asarray([1.0, 0.5, 2.0])
+        p = 5
+        out = np.empty((3, 3, p), dtype=np.float32)
+        func(csum, starts, stops, heights, out)
+        for j in range(3):
+            expected = (csum[:, stops[j]:stops[j]+p] - csum[:, starts[j]:starts[j]+p]) * heights[j]
+            self.assertTrue(np.allclose(out[:, j], expected, atol=1e-6))
+
+    def test_numpy(self):
+        self.check_cumsum(normalised_cumsum_numpy)
+        self.check_moving_sums(moving_sums_numpy)
+
+    @unittest.skipIf(normalised_cumsum_numba is None, "numba not installed")
+    def test_numba(self):
+        self.check_cumsum(normalised_cumsum_numba)
+        self.check_moving_sums(moving_sums_numba)
+
+
+# Calls a parallel kernel from several threads at once
+THREADS_SCRIPT = """
+import threading
+import numpy as np
+from spyden._kernels import diffcov_std
+x = np.random.default_rng(0).normal(size=(64, 4096))
+def run():
+    for _ in range(50):
+        diffcov_std(x)
+threads = [threading.Thread(target=run) for _ in range(4)]
+for t in threads:
+    t.start()
+for t in threads:
+    t.join()
+"""
+
+
+class TestThreadSafety(unittest.TestCase):
+    """ """
+    @unittest.skipIf(diffcov_std_numba is None, "numba not installed")
+    def test_workqueue(self):
+        """ Concurrent kernel calls must not abort the process under the workqueue threading layer """
+        env = dict(os.environ, NUMBA_THREADING_LAYER='workqueue', NUMBA_NUM_THREADS='2')
+        proc = subprocess.run([sys.executable, '-c', THREADS_SCRIPT], env=env, capture_output=True)
+        self.assertEqual(proc.returncode, 0, proc.stderr.decode())
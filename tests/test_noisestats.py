@@ -0,0 +1,81 @@
+import unittest
+import numpy as np
+
+from spyden import noise_std
+from spyden.noisestats import quartiles
+
+import reference
+
+
+class TestNoiseStats(unittest.TestCase):
+    """ """
+    def test_quartiles(self):
+        rng = np.random.default_rng(0)
+        # Cover all possible interpolation fractions
+        for n in range(1, 12):
+            x = rng.normal(size=(3, n))
+            q1, q3 = quartiles(x)
+            e1, e3 = np.percentile(x, (25, 75), axis=-1)
+            self.assertEqual(q1.shape, (3,))
+            self.assertTrue(np.allclose(q1, e1))
+            self.assertTrue(np.allclose(q3, e3))
+
+        x = rng.normal(size=100)
+        q1, q3 = quartiles(x)
+        self.assertTrue(np.allclose([q1, q3], np.percentile(x, (25, 75))))
+
+        expected = np.percentile(x, (25, 75))
+        q1, q3 = quartiles(x, overwrite_input=True)
+        self.assertTrue(np.allclose([q1, q3], expected))
+
+    def test_noise_std(self):
+        rng = np.random.default_rng(0)
+        x = rng.normal(scale=2.0, size=(4, 10000))
+        for method in ('iqr', 'diffcov'):
+            sigma = noise_std(x, method=method)
+            self.assertEqual(sigma.shape, (4,))
+            self.assertTrue(np.allclose(sigma, 2.0, rtol=0.05))
+
+        sigma = noise_std(x[0])
+        self.assertEqual(np.ndim(sigma), 0)
+
+    def test_iqr_offset(self):
+        """ IQR estimate must not lose precision on data with a large offset """
+        rng = np.random.default_rng(0)
+        x = rng.normal(size=(8, 1000))
+        for offset in (1e6, 1e7, 1e9):
+            y = x + offset
+            q1, q3 = np.percentile(y, (25, 75), axis=-1)
+            expected = (q3 - q1) / 1.3489795003921634
+            self.assertTrue(np.allclose(noise_std(y, method='iqr'), expected, rtol=1e-5))
+
+    def test_iqr_outlier_first_bin(self):
+        """ IQR estimate must be robust to an outlier in any bin, the first included """
+        rng = np.random.default_rng(0)
+        x = rng.normal(size=(8, 1024))
+        for spike in (1e6, 1e7, 1e8):
+            y = x.copy()
+            y[:, 0] = spike
+            q1, q3 = np.percentile(y, (25, 75), axis=-1)
+            expected = (q3 - q1) / 1.3489795003921634
+            self.assertTrue(np.allclose(noise_std(y, method='iqr'), expected, rtol=1e-5))
+
+    def test_diffcov(self):
+        rng = np.random.default_rng(0)
+        x = rng.normal(size=(4, 100)) + np.linspace(0, 10, 100)
+        expected = reference.diffcov_std(x)
+        self.assertTrue(np.allclose(noise_std(x, method='diffcov'), expected))
+
+        sigma = noise_std(x[0], method='diffcov')
+        self.assertEqual(np.ndim(sigma), 0)
+        self.assertAlmostEqual(sigma, expected[0])
+
+        # Input dtypes that numba kernels cannot read
+        sigma = noise_std(x.astype(np.float16), method='diffcov')
+        self.assertTrue(np.allclose(sigma, expected, rtol=1e-2))
+
+        with self.assertRaises(ValueError):
+            noise_std(x.reshape(2, 2, 100), method='diffcov')
+
+        with self.assertRaises(ValueError):
+            noise_std(x, method='unknown')
@@ -1,7 +1,12 @@
 import unittest
+from unittest import mock
 import numpy as np
 
-from spyden import snratio, Template, TemplateBank
+from spyden import snratio, snratio_reduce, Template, TemplateBank
+from spyden import _fft, _kernels
+from spyden.snr import _template_blocks, _has_constant_data
+
+import reference
 
 
 class TestSnratio(unittest.TestCase):
@@ -87,4 +92,187 @@ class TestSnratio(unittest.TestCase):
         iprof, itemp, ibin = np.unravel_index(snr.argmax(), snr.shape)
         self.assertEqual(iprof, i0)
         self.assertEqual(itemp, 0)
-        self.assertEqual(ibin, j0 + w0 // 2)
\ No newline at end of file
+        self.assertEqual(ibin, j0 + w0 // 2)
+
+    def test_circular_convolution(self):
+        """ Compare S/N to a direct circular convolution """
+        rng = np.random.default_rng(0)
+        bank = TemplateBank([
+            Template.boxcar(3),
+            Template.gaussian(5.0),
+            Template(np.arange(1.0, 6.0), refbin=4),
+        ])
+
+        # Sizes that do and do not need padding
+        for size in (100, 97):
+            data = rng.normal(size=(2, size))
+            snr, mu, sigma, models = snratio(data, bank, mu=0.0, sigma=1.0, workers=1)
+
+            for itemp, t in enumerate(bank):
+                expected = reference.circular_convolution(data, t)
+                self.assertTrue(np.allclose(snr[:, itemp], expected, atol=1e-4))
+
+    def test_models(self):
+        """ Compare models to the best template placed at the best bin """
+        rng = np.random.default_rng(0)
+        data = rng.normal(size=(4, 50))
+        # Pulses that wrap around the edges of the data
+        data[0, :3] += 8.0
+        data[1, -2:] += 8.0
+        bank = TemplateBank([
+            Template.boxcar(3),
+            Template(np.arange(1.0, 6.0), refbin=4),
+        ])
+
+        snr, mu, sigma, models = snratio(data, bank)
+        for iprof in range(len(data)):
+            itemp, ibin = np.unravel_index(snr[iprof].argmax(), snr[iprof].shape)
+            t = bank[itemp]
+            expected = np.zeros(50)
+            expected[:t.size] = t.data * sigma[iprof] * snr[iprof].max()
+            expected = np.roll(expected, ibin - t.refbin) + mu[iprof]
+            self.assertTrue(np.allclose(models[iprof], expected))
+
+        # Template longer than the data, which wraps onto itself
+        t = Template.gaussian(8.0)
+        snr, mu, sigma, models = snratio(data[:, :20], t)
+        for iprof in range(len(data)):
+            ibin = snr[iprof, 0].argmax()
+            expected = np.full(20, mu[iprof])
+            cols = (ibin - t.refbin + np.arange(t.size)) % 20
+            np.add.at(expected, cols, t.data * sigma[iprof] * snr[iprof].max())
+            self.assertTrue(np.allclose(models[iprof], expected))
+
+    def test_constant_templates(self):
+        """ S/N of constant templates, computed without FFTs """
+        rng = np.random.default_rng(0)
+        size = 30
+        data = rng.normal(size=(3, size))
+        bank = TemplateBank([
+            Template.boxcar(1),
+            Template.boxcar(4),
+            Template(np.ones(5), refbin=3),
+            # Longer than the data
+            Template(np.ones(40), refbin=10),
+        ])
+        self.assertTrue(_has_constant_data(bank))
+        self.assertTrue(_has_constant_data(bank[0]))
+        self.assertFalse(_has_constant_data(Template.gaussian(3.0)))
+
+        snr, mu, sigma, models = snratio(data, bank, mu=0.0, sigma=1.0)
+        self.assertEqual(snr.dtype, np.float32)
+        self.assertEqual(snr.shape, (3, len(bank), size))
+        for itemp, t in enumerate(bank):
+            expected = reference.circular_convolution(data, t)
+            self.assertTrue(np.allclose(snr[:, itemp], expected, atol=1e-5))
+
+        best, itemp, ibin, __, __, rmodels = snratio_reduce(data, bank, mu=0.0, sigma=1.0)
+        self.assertTrue(np.allclose(best, snr.max(axis=(1, 2))))
+        self.assertTrue(np.allclose(rmodels, models))
+
+    def test_offset(self):
+        """ S/N must not lose precision on data with a large offset """
+        rng = np.random.default_rng(0)
+        size = 64
+        x = rng.normal(size=(2, size))
+        t = Template.gaussian(3.0)
+        expected = reference.circular_convolution(x, t)
+        for offset in (1e6, 1e7):
+            snr, mu, sigma, models = snratio(x + offset, t, mu=offset, sigma=1.0)
+            self.assertTrue(np.allclose(snr[:, 0], expected, atol=1e-4))
+
+        # Input dtypes that numba kernels cannot read, including big-endian
+        # data as read from FITS files
+        for temp in (t, Template.boxcar(3)):
+            snr, mu, sigma, models = snratio(x.astype(np.float16), temp)
+            self.assertEqual(snr.shape, (2, 1, size))
+            for dtype in ('>i2', '>f4'):
+                y = (100 * x).astype(dtype)
+                snr, mu, sigma, models = snratio(y, temp)
+                native, __, __, __ = snratio(y.astype(y.dtype.newbyteorder('=')), temp)
+                # NOTE: the noise std is estimated in float32 or float64
+                # depending on the input dtype
+                self.assertTrue(np.allclose(snr, native, atol=1e-5))
+
+    @unittest.skipIf(_kernels.njit is None, "numba not installed")
+    def test_kernel_threads(self):
+        """ workers also limits the number of threads of the numba kernels """
+        import numba
+        data = np.random.default_rng(0).normal(size=(2, 64))
+        previous = numba.get_num_threads()
+        threads = []
+
+        def moving_sums(*args):
+            threads.append(numba.get_num_threads())
+            _kernels.moving_sums(*args)
+
+        with mock.patch('spyden.snr.moving_sums', moving_sums):
+            for func in (snratio, snratio_reduce):
+                func(data, TemplateBank.boxcars(range(1, 5)), sigma='diffcov', workers=1)
+        self.assertEqual(threads, [1, 1])
+        self.assertEqual(numba.get_num_threads(), previous)
+
+    def test_invalid_workers_backend(self):
+        """ Invalid workers and backend raise on both FFT and moving sum paths """
+        data = np.random.default_rng(0).normal(size=(2, 64))
+        for temp in (Template.gaussian(3.0), Template.boxcar(4)):
+            for func in (snratio, snratio_reduce):
+                for workers in (0, 'x', 1.0):
+                    with self.assertRaises(ValueError):
+                        func(data, temp, workers=workers)
+                with self.assertRaises(ValueError):
+                    func(data, temp, backend='gpu')
+                if _fft.cupy is None:
+                    with self.assertRaises(ValueError):
+                        func(data, temp, backend='cupy')
+
+    def test_template_blocks(self):
+        """ S/N map must not depend on how templates are split into blocks """
+        rng = np.random.default_rng(0)
+        data = rng.normal(size=(3, 100))
+        bank = TemplateBank.gaussians(range(1, 8))
+        snr, mu, sigma, models = snratio(data, bank)
+
+        # Budget for 3 templates per block: 3 blocks of 3, with 2 extra rows
+        n = 100
+        nbytes = 3 * (4 * n + 8 * (n // 2 + 1))
+        block, fy = _template_blocks(3, n, bank.rfft_prepared(n), 3 * nbytes)
+        self.assertEqual(block, 3)
+        self.assertEqual(len(fy), 9)
+        with mock.patch('spyden.snr.WORK_BUFFER_BYTES', 3 * nbytes):
+            bsnr, __, __, bmodels = snratio(data, bank)
+        self.assertTrue(np.allclose(bsnr, snr, atol=1e-6))
+        self.assertTrue(np.allclose(bmodels, models))
+
+    def test_reduce(self):
+        """ Compare snratio_reduce() with the maximum of the S/N map """
+        rng = np.random.default_rng(0)
+        data = rng.normal(size=(5, 100))
+        data[2, 42:47] += 5.0
+        bank = TemplateBank.gaussians([1.0, 2.0, 4.0])
+
+        snr, mu, sigma, models = snratio(data, bank)
+        best, itemp, ibin, rmu, rsigma, rmodels = snratio_reduce(data, bank)
+        self.assertEqual(best.shape, (5,))
+        self.assertTrue(np.allclose(best, snr.max(axis=(1, 2))))
+        self.assertTrue(np.allclose(rmu, mu))
+        self.assertTrue(np.allclose(rsigma, sigma))
+        self.assertTrue(np.allclose(rmodels, models))
+        for iprof in range(len(data)):
+            expected = np.unravel_index(snr[iprof].argmax(), snr[iprof].shape)
+            self.assertEqual((itemp[iprof], ibin[iprof]), expected)
+        self.assertEqual(ibin[2], 44)
+
+        # Templates split into 2 blocks of 2, with an extra padding row
+        nbytes = 5 * (4 * 100 + 8 * 51)
+        with mock.patch('spyden.snr.L2_CACHE_BYTES', 2 * nbytes):
+            bbest, bitemp, bibin, __, __, bmodels = snratio_reduce(data, bank)
+        self.assertTrue(np.allclose(bbest, best))
+        self.assertTrue(np.array_equal(bitemp, itemp))
+        self.assertTrue(np.array_equal(bibin, ibin))
+        self.assertTrue(np.allclose(bmodels, rmodels))
+
+        best, itemp, ibin, rmu, rsigma, rmodels = snratio_reduce(data[2], bank[0])
+        self.assertEqual(best.shape, (1,))
+        self.assertTrue(np.allclose(best, snratio(data[2], bank[0])[0].max()))
+        self.assertEqual(rmodels.shape, (1, 100))
@@ -3,7 +3,7 @@ import numpy as np
 import matplotlib.pyplot as plt
 
 from spyden import Template, TemplateBank
-from spyden.template import normalise
+from spyden.template import normalise, RFFT_CACHE_SIZE
 
 
 class TestTemplate(unittest.TestCase):
@@ -68,6 +68,31 @@ class TestTemplate(unittest.TestCase):
         self.assertEqual(m0, 0)
         self.assertEqual(m1, size_padded - 1)
 
+        ### compare with padding, rolling and reversing explicitly
+        for n in (size, size_padded):
+            x = np.pad(t.data, (0, n - size))
+            x = np.roll(x, -refbin)
+            expected = np.roll(x[::-1], 1)
+            self.assertTrue(np.allclose(t.prepared_data(n), expected))
+
+    def test_rfft_prepared(self):
+        t = Template.gaussian(3.0)
+        n = 16
+        fy = t.rfft_prepared(n)
+        self.assertEqual(fy.dtype, np.complex64)
+        self.assertTrue(np.allclose(fy, np.fft.rfft(t.prepared_data(n)), atol=1e-6))
+        self.assertIs(fy, t.rfft_prepared(n))
+        self.assertFalse(fy.flags.writeable)
+
+        # Least recently used entries are evicted
+        for k in range(RFFT_CACHE_SIZE - 1):
+            t.rfft_prepared(n + 1 + k)
+        self.assertIs(fy, t.rfft_prepared(n))
+        t.rfft_prepared(n + RFFT_CACHE_SIZE)
+        self.assertIs(fy, t.rfft_prepared(n))
+        self.assertNotIn(n + 1, t._fy_cache)
+        self.assertEqual(len(t._fy_cache), RFFT_CACHE_SIZE)
+
     def test_boxcar(self):
         w = 5
         t = Template.boxcar(w)
@@ -92,4 +117,45 @@ class TestTemplateBank(unittest.TestCase):
         bank = TemplateBank.boxcars(range(1, 5))
 
     def test_gaussians(self):
-        bank = TemplateBank.gaussians(range(1, 5))
\ No newline at end of file
+        bank = TemplateBank.gaussians(range(1, 5))
+
+    def test_prepared_data(self):
+        bank = TemplateBank([
+            Template.boxcar(3),
+            Template.gaussian(5.0),
+            Template(np.arange(1.0, 6.0), refbin=4),
+        ])
+        for n in (bank.maxsize, 32):
+            expected = np.asarray([t.prepared_data(n) for t in bank])
+            prep = bank.prepared_data(n)
+            self.assertEqual(prep.dtype, np.float32)
+            self.assertTrue(np.allclose(prep, expected))
+
+        with self.assertRaises(ValueError):
+            bank.prepared_data(bank.maxsize - 1)
+
+    def test_packed(self):
+        """ A Template packs like a TemplateBank with only that template """
+        t = Template(np.arange(1.0, 6.0), refbin=4)
+        data, refbins, sizes = t._packed()
+        bdata, brefbins, bsizes = TemplateBank([t])._packed()
+        self.assertEqual(data.dtype, np.float32)
+        self.assertTrue(np.array_equal(data, bdata))
+        self.assertTrue(np.array_equal(refbins, brefbins))
+        self.assertTrue(np.array_equal(sizes, bsizes))
+        self.assertIs(t._packed(), t._packed())
+
+    def test_rfft_prepared(self):
+        bank = TemplateBank.boxcars(range(1, 5))
+        n = 16
+        fy = bank.rfft_prepared(n)
+        self.assertEqual(fy.shape, (len(bank), n // 2 + 1))
+        self.assertEqual(fy.dtype, np.complex64)
+        self.assertTrue(np.allclose(fy, np.fft.rfft(bank.prepared_data(n)), atol=1e-6))
+        self.assertIs(fy, bank.rfft_prepared(n))
+
+        # Cache must be invalidated when the bank is modified
+        bank.append(Template.gaussian(2.0))
+        fy = bank.rfft_prepared(n)
+        self.assertEqual(fy.shape, (len(bank), n // 2 + 1))
+        self.assertTrue(np.allclose(fy, np.fft.rfft(bank.prepared_data(n)), atol=1e-6))
\ No newline at end of file